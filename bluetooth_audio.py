@@ -4,9 +4,16 @@ import bluetooth
 import logging
 import time
 import threading
+import selectors
+import select
+import socket
 import struct
 import sys
-import math
+import functools
+import collections
+import json
+import os
+import tempfile
 
 # from specs
 SOL_BLUETOOTH = 274
@@ -18,6 +25,51 @@ SCO_OPTIONS = 1
 L2CAP_UUID = "0100"
 SCO_HEADERS_SIZE = 16
 
+_LOG = logging.getLogger(__name__)
+
+# samples are signed 16 bit little endian, on little endian hosts numpy uses it
+# as the native int16 type, so conversions never swap bytes
+SAMPLE_DTYPE = '<i2'
+# 16 bit socket options
+SOCKOPT_U16 = struct.Struct('H')
+# RFCOMM channels found by SDP discovery, by device address
+CHANNEL_CACHE_FILE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+	'bluetooth_audio.json')
+# serializes read-modify-write of the cache file between instances
+_channels_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=16)
+def _tone_period(period, amplitude):
+	# one period of signed 16 bit le sine wave, beeps are built by repeating it
+	import numpy as np
+	t = np.arange(period)
+	return (32767.0 * amplitude * np.sin(2.0 * np.pi * t / period)).astype(SAMPLE_DTYPE).tobytes()
+
+def _load_channels():
+	try:
+		with open(CHANNEL_CACHE_FILE) as f:
+			channels = json.load(f)
+	except (OSError, ValueError):
+		return {}
+	if not isinstance(channels, dict):
+		return {}
+	# file may be edited by hand, keep only valid channel numbers
+	return {addr: c for addr, c in channels.items() if type(c) is int and c > 0}
+
+def _save_channels(channels):
+	tmp = None
+	try:
+		cache_dir = os.path.dirname(CHANNEL_CACHE_FILE)
+		os.makedirs(cache_dir, exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=cache_dir)
+		with os.fdopen(fd, 'w') as f:
+			json.dump(channels, f)
+		os.replace(tmp, CHANNEL_CACHE_FILE)
+	except OSError as e:
+		_LOG.warning('Failed to save RFCOMM channel cache: %s', e)
+		if tmp and os.path.exists(tmp):
+			os.remove(tmp)
+
 class BluetoothAudio:
 	""" This object connect to Bluetooth handset/nandsfree device
 	    stream audio from microphone and to speaker.
@@ -27,6 +79,7 @@ class BluetoothAudio:
 	AUDIO_8KHZ_SIGNED_16BIT_LE_MONO = 0
 	AUDIO_16KHZ_SIGNED_16BIT_LE_MONO = 1
 	CAPTURE_BUFFER_MAX_SIZE = 16777216 # 16 Mb
+	AT_BUFFER_MAX_SIZE = 4096
 
 	def __init__(self, addr, format = AUDIO_8KHZ_SIGNED_16BIT_LE_MONO):
 		""" Create object which connects to bluetooth device in the background.
@@ -36,16 +89,22 @@ class BluetoothAudio:
 		self.audio = None
 		self.hfp = None
 		self.addr = addr
+		self._cached_channel = _load_channels().get(addr.upper())
 		self.resample = (format == self.AUDIO_16KHZ_SIGNED_16BIT_LE_MONO)
+		# written to wake up worker thread, see _wakeup()
+		self._wakeup_r, self._wakeup_w = socket.socketpair()
 		self.wlt = threading.Thread(target=self._worker_loop)
 		self.wlt.start()
-		self.buf =  bytes()
+		self.buf =  bytearray()
 		self.rlt = None
 		self.rltl = threading.Lock()
 
 	def _read_loop(self):
-		logging.info('Read loop start')
-		self.buf = bytes()
+		_LOG.info('Read loop start')
+		self.buf = bytearray()
+		if self.resample:
+			# numpy is imported only when conversion is needed, it is slow to load on small boards
+			import numpy as np
 		while self.rlt:
 			try:
 				data_raw = self.audio.recv(self.sco_payload)
@@ -54,78 +113,129 @@ class BluetoothAudio:
 			if not data_raw or len(data_raw) == 0:
 				self.audio.close()
 				self.audio = None
-				logging.warning('Capture audio failed')
+				_LOG.warning('Capture audio failed')
+				self._wakeup()
 				break
 			if self.resample:
-				# convert data
-				data = bytes()
-				prev = 0
-				for i in range(0, len(data_raw), 2):
-					# convert from 8 kHz signed 16 bit le to 16 kHz signed 16 bit le
-					v = struct.unpack_from('<h', data_raw, i)[0]
-					data += struct.pack('<hh', int((prev + v) / 2), v)
-					prev = v
+				# convert from 8 kHz signed 16 bit le to 16 kHz signed 16 bit le,
+				# each sample is preceded by the average with the previous one
+				# integer only operations, numpy runs them with SIMD loops
+				v = np.frombuffer(data_raw, dtype=SAMPLE_DTYPE, count=len(data_raw) // 2)
+				avg = v.astype(np.int32)
+				avg[1:] += v[:-1]
+				avg += avg < 0 # halve rounding toward zero
+				avg >>= 1
+				out = np.empty(len(v) * 2, dtype=SAMPLE_DTYPE)
+				out[0::2] = avg
+				out[1::2] = v
+				data = out.tobytes()
 			else:
 				data = data_raw
 			self.rltl.acquire(True)
 			if len(self.buf) > self.CAPTURE_BUFFER_MAX_SIZE:
-				logging.warning('Capture buffer overflow')
-				self.buf = bytes()
+				_LOG.warning('Capture buffer overflow')
+				self.buf.clear()
 			self.buf += data
 			self.rltl.release()
-		logging.info('Read loop stop')
+		_LOG.info('Read loop stop')
 
 	def _worker_loop(self):
-		logging.info('HFPDevice class is initialised, using ' + self.addr)
+		_LOG.info('HFPDevice class is initialised, using %s', self.addr)
 		while self.wlt:
 			self._find_channel()
 			if not self.channel:
-				time.sleep(self.HFP_TIMEOUT)
+				self._sleep(self.HFP_TIMEOUT)
 				continue
-			logging.info('HSP/HFP found on RFCOMM channel ' + str(self.channel))
+			_LOG.info('HSP/HFP found on RFCOMM channel %s', self.channel)
 			self._connect_service_level()
 			if not self.hfp:
-				time.sleep(self.HFP_TIMEOUT)
+				# channel may be outdated, discover it again next time
+				self._set_cached_channel(None)
+				self._sleep(self.HFP_TIMEOUT)
 				continue
 			try:
 				self._parse_channel()
 			except bluetooth.btcommon.BluetoothError as e:
-				logging.warning('Service level connection disconnected: ' + str(e))
-				time.sleep(self.HFP_TIMEOUT)
+				_LOG.warning('Service level connection disconnected: %s', e)
+				self._sleep(self.HFP_TIMEOUT)
 			self._cleanup()
 
+	def _wakeup(self):
+		self._wakeup_w.send(b'\0')
+
+	def _sleep(self, timeout):
+		# like time.sleep(), but returns early on _wakeup()
+		if select.select([self._wakeup_r], [], [], timeout)[0]:
+			self._wakeup_r.recv(64)
+
+	def _on_brsf(self):
+		self._send_reply(b'+BRSF: 0')
+
+	def _on_cind_test(self):
+		self._send_reply(b'+CIND: ("service",(0,1)),("call",(0,1))')
+
+	def _on_cind_read(self):
+		self._send_reply(b'+CIND: 1,0')
+
+	def _on_cmer(self):
+		self._send_ok()
+		# after this command we can establish audio connection
+		self._service_notice = False
+		self._connect_audio()
+
+	def _on_chld_test(self):
+		self._send_reply(b'+CHLD: 0')
+
+	# AT command handlers, commands with arguments are matched up to '='
+	_AT_DISPATCH = {
+		b'AT+BRSF=': _on_brsf,
+		b'AT+CIND=?': _on_cind_test,
+		b'AT+CIND?': _on_cind_read,
+		b'AT+CMER=': _on_cmer,
+		b'AT+CHLD=?': _on_chld_test,
+	}
+
+	def _dispatch_at(self, data):
+		cmd = data.strip()
+		handler = self._AT_DISPATCH.get(cmd)
+		if not handler:
+			key, sep, _ = cmd.partition(b'=')
+			if sep:
+				handler = self._AT_DISPATCH.get(key + sep)
+		if handler:
+			handler(self)
+		else:
+			self._send_error()
+
 	def _parse_channel(self):
 		audio_time = time.time() + self.HFP_CONNECT_AUDIO_TIMEOUT
-		sevice_notice = True
-		while self.wlt:
-			data = self._read_at()
-			if data:
-				if b'AT+BRSF=' in data:
-					self._send_at(b'+BRSF: 0')
-					self._send_ok()
-				elif b'AT+CIND=?\r' == data:
-					self._send_at(b'+CIND: ("service",(0,1)),("call",(0,1))')
-					self._send_ok()
-				elif b'AT+CIND?\r' == data:
-					self._send_at(b'+CIND: 1,0')
-					self._send_ok()
-				elif b'AT+CMER=' in data:
-					self._send_ok()
-					# after this command we can establish audio connection
-					sevice_notice = False
-					self._connect_audio()
-				elif b'AT+CHLD=?\r' == data:
-					self._send_at(b'+CHLD: 0')
-					self._send_ok()
-				else:
-					self._send_error()
-			# if we don't get service level connection, try audio anyway
-			if not self.audio:
-				if audio_time < time.time():
-					if sevice_notice:
-						logging.warning('Service connection timed out, try audio anyway...')
-						sevice_notice = False
-					self._connect_audio()
+		self._service_notice = True
+		sel = selectors.DefaultSelector()
+		sel.register(self.hfp, selectors.EVENT_READ)
+		sel.register(self._wakeup_r, selectors.EVENT_READ)
+		try:
+			while self.wlt:
+				# sleep until AT command arrives, _wakeup() is called
+				# or audio connection should be established
+				timeout = None
+				if not self.audio:
+					timeout = max(audio_time - time.time(), 0)
+				for key, _ in sel.select(timeout):
+					if key.fileobj is self.hfp:
+						for cmd in self._iter_at():
+							self._dispatch_at(cmd)
+					else:
+						self._wakeup_r.recv(64)
+				# if we don't get service level connection, try audio anyway
+				if not self.audio:
+					if audio_time <= time.time():
+						if self._service_notice:
+							_LOG.warning('Service connection timed out, try audio anyway...')
+							self._service_notice = False
+						self._connect_audio()
+						audio_time = time.time() + self.HFP_TIMEOUT
+		finally:
+			sel.close()
 
 	def _connect_service_level(self):
 		hfp = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
@@ -133,32 +243,55 @@ class BluetoothAudio:
 			hfp.connect((self.addr, self.channel))
 		except bluetooth.btcommon.BluetoothError as e:
 			hfp.close()
-			logging.warning('Failed to establish service level connection: ' + str(e))
+			_LOG.warning('Failed to establish service level connection: %s', e)
 			return
 		hfp.settimeout(self.HFP_TIMEOUT)
-		logging.info('HSP/HFP service level connection is established')
+		_LOG.info('HSP/HFP service level connection is established')
+		self._rx_buf = bytearray()
 		self.hfp = hfp
 
 	def _connect_audio(self):
 		audio = bluetooth.BluetoothSocket(bluetooth.SCO)
 		# socket config
-		opt = struct.pack ("H", BT_VOICE_CVSD_16BIT)
+		opt = SOCKOPT_U16.pack(BT_VOICE_CVSD_16BIT)
 		audio.setsockopt(SOL_BLUETOOTH, BT_VOICE, opt)
 		try:
 			audio.connect((self.addr,))
 		except bluetooth.btcommon.BluetoothError as e:
 			audio.close()
-			logging.info('Failed to establish audio connection: ' + str(e))
+			_LOG.info('Failed to establish audio connection: %s', e)
 			return
 		opt = audio.getsockopt(SOL_SCO, SCO_OPTIONS, 2)
-		mtu = struct.unpack('H', opt)[0]
+		mtu = SOCKOPT_U16.unpack(opt)[0]
 		self.audio = audio
 		self.sco_payload = mtu - SCO_HEADERS_SIZE
+		self._send_pad = bytes(self.sco_payload)
 		self.rlt = threading.Thread(target=self._read_loop)
 		self.rlt.start()
-		logging.info('Audio connection is established, mtu = ' + str(mtu))
+		_LOG.info('Audio connection is established, mtu = %s', mtu)
+
+	def _set_cached_channel(self, channel):
+		if channel == self._cached_channel:
+			return
+		self._cached_channel = channel
+		with _channels_lock:
+			channels = _load_channels()
+			if channel:
+				channels[self.addr.upper()] = channel
+			else:
+				channels.pop(self.addr.upper(), None)
+			_save_channels(channels)
 
 	def _find_channel(self):
+		# SDP discovery is slow, reuse the channel found before until it fails to connect
+		if self._cached_channel:
+			self.channel = self._cached_channel
+			return
+		self._discover_channel()
+		if self.channel:
+			self._set_cached_channel(self.channel)
+
+	def _discover_channel(self):
 		# discovery RFCOMM channell, prefer HFP.
 		hsp_channel = None
 		generic_channel = None
@@ -181,20 +314,45 @@ class BluetoothAudio:
 	def _read_at(self):
 		try:
 			d = self.hfp.recv(1024)
-			logging.debug('> ' + d.decode('utf8'))
+			if _LOG.isEnabledFor(logging.DEBUG):
+				_LOG.debug('> %s', d.decode('utf8', 'replace'))
 			return d
 		except bluetooth.btcommon.BluetoothError as e:
 			if str(e) != 'timed out':
 				raise
 			return None
 
+	def _iter_at(self):
+		# one recv may carry several commands or a part of one,
+		# yield complete commands and keep the rest for the next call
+		d = self._read_at()
+		if d == b'':
+			raise bluetooth.btcommon.BluetoothError('connection closed')
+		if d:
+			self._rx_buf += d
+		while True:
+			end = self._rx_buf.find(b'\r')
+			if end < 0:
+				break
+			cmd = bytes(self._rx_buf[:end]).strip()
+			del self._rx_buf[:end + 1]
+			if cmd:
+				yield cmd
+		if len(self._rx_buf) > self.AT_BUFFER_MAX_SIZE:
+			raise bluetooth.btcommon.BluetoothError('AT command is too long')
+
 	def _send(self, data):
-		logging.debug('< ' + data.decode('utf8').replace('\r\n', ''))
+		if _LOG.isEnabledFor(logging.DEBUG):
+			_LOG.debug('< %s', data.decode('utf8', 'replace').replace('\r\n', ''))
 		self.hfp.send(data)
 
 	def _send_at(self, data):
 		self._send(b'\r\n' + data + b'\r\n')
 
+	def _send_reply(self, data):
+		# result code and final OK in one packet
+		self._send(b'\r\n' + data + b'\r\n\r\nOK\r\n')
+
 	def _send_ok(self):
 		self._send_at(b'OK')
 
@@ -216,8 +374,11 @@ class BluetoothAudio:
 	def close(self):
 		wlt = self.wlt
 		self.wlt = None
+		self._wakeup()
 		wlt.join()
 		self._cleanup()
+		self._wakeup_r.close()
+		self._wakeup_w.close()
 
 	def is_connected(self):
 		""" Check if headset/handfree device is connected.
@@ -229,14 +390,15 @@ class BluetoothAudio:
 		""" Clean up capture buffer
 		"""
 		self.rltl.acquire(True)
-		self.buf = bytes()
+		self.buf.clear()
 		self.rltl.release()
 
 	def read(self, length = None):
 		""" Receive audio from bluetooth device. Block until read something.
 		:param length: number of bytes(not samples) to read, not more then CAPTURE_BUFFER_MAX_SIZE.
 		               If None or 0, all aviliable will be read
-		:return: Array with audio data(16 kHz signed 16 bit little endian mono data) or None on error.
+		:return: Array with audio data(signed 16 bit little endian mono data, 8 or 16 kHz according
+		         to the format passed to constructor) or None on error.
 		"""
 		if not self.rlt:
 			return None
@@ -256,38 +418,45 @@ class BluetoothAudio:
 				self.rlt.join(s)
 		self.rltl.acquire(True)
 		if length == 0:
-			data = self.buf
-			self.buf = bytes()
+			data = bytes(self.buf)
+			self.buf.clear()
 		else:
-			data = self.buf[0:length]
-			self.buf =self.buf[length:]
+			data = memoryview(self.buf)[0:length].tobytes()
+			del self.buf[0:length]
 		self.rltl.release()
 		return data
 
 	def write(self, data):
 		""" Send audio data to bluetooth device. Blocking.
-		:param data: array with audio data.
-		:param format: audio fromat, for example AUDIO_8KHZ_SIGNED_8BIT_MONO or AUDIO_16KHZ_SIGNED_16BIT_LE_MONO.
+		:param data: array with audio data(signed 16 bit little endian mono data, 8 or 16 kHz according
+		             to the format passed to constructor).
 		:return: True on success, False on error.
 		"""
 		if not self.audio:
 			return False
 		try:
 			if self.resample:
-				# convert data
-				data_raw = bytes()
-				for i in range(0, len(data), 4):
-					val1, val2 = struct.unpack_from('<hh', data, i) # two samples of signed 16 bit le
-					val = round((val1 + val2) / 2) # downsample to 8 kHz
-					data_raw += struct.pack('<h', val)
+				import numpy as np
+				# downsample to 8 kHz, average each pair of signed 16 bit le samples,
+				# sum is widened to 32 bit to avoid overflow
+				n = len(data) // 4
+				pairs = np.frombuffer(data, dtype=SAMPLE_DTYPE, count=n * 2).reshape(n, 2)
+				val = np.add(pairs[:, 0], pairs[:, 1], dtype=np.int32)
+				half = val >> 1
+				val &= half
+				val &= 1 # round half to even, as round() did
+				out = np.empty(n, dtype=SAMPLE_DTYPE)
+				np.add(half, val, out=out, casting='unsafe')
+				data_raw = out.tobytes()
 			else:
 				data_raw = data
-			sent = 0
-			while sent < len(data_raw):
-				ts = data_raw[sent:(sent+int(self.sco_payload))]
-				if len(ts) < self.sco_payload:
-					ts += bytes([0] * (self.sco_payload - len(ts)))
-				sent += self.audio.send(ts)
+			data_raw = memoryview(data_raw)
+			payload = self.sco_payload
+			for sent in range(0, len(data_raw), payload):
+				ts = data_raw[sent:(sent+payload)]
+				if len(ts) < payload:
+					ts = bytes(ts) + self._send_pad[:payload - len(ts)]
+				self.audio.send(ts)
 			return True
 		except bluetooth.btcommon.BluetoothError:
 			return False
@@ -301,20 +470,53 @@ class BluetoothAudio:
 		fps = 8000
 		if self.resample:
 			fps = 16000
-		logging.info('Beep {} Hz, {} ms'.format(frequency, length_ms))
+		_LOG.info('Beep %s Hz, %s ms', frequency, length_ms)
 		period = int(fps / frequency)
 		length = int(fps * length_ms / 1000)
-		snd = bytes()
-		for i in range(0, length):
-			val = 32767.0 * amplitude * math.sin(2.0 * math.pi * float(i % period) / period)
-			snd += struct.pack('<h', int(val))
-		return self.write(snd)
+		wave = _tone_period(period, amplitude)
+		return self.write((wave * (length // period + 1))[:length * 2])
 
 
 def demo_ring(hf):
 	time.sleep(1)
 	hf._send_at(b'RING')
 
+def loopback(hf, max_chunks = 64):
+	""" Play audio captured from the device back to it.
+	    Playback runs in its own thread fed by a bounded FIFO, so a blocking write
+	    does not delay reading. If playback falls behind the oldest audio is dropped.
+	"""
+	fifo = collections.deque(maxlen=max_chunks)
+	ready = threading.Condition()
+	stop = threading.Event()
+
+	def play():
+		while True:
+			with ready:
+				while not fifo and not stop.is_set():
+					ready.wait()
+				if stop.is_set():
+					return
+				d = fifo.popleft()
+			hf.write(d)
+
+	player = threading.Thread(target=play)
+	player.start()
+	try:
+		while True:
+			d = hf.read()
+			if d:
+				with ready:
+					fifo.append(d)
+					ready.notify()
+			else:
+				time.sleep(0.5)
+	finally:
+		with ready:
+			stop.set()
+			ready.notify()
+		player.join()
+
 def main():
 	""" Sample of usage BluetoothAudio.
 	    This sample loopback audio from microphone to speaker.
@@ -343,18 +545,11 @@ def main():
 		hf.beep()
 		time.sleep(0.5)
 		hf.flush()
-		while True:
-			d = hf.read()
-			if d:
-				hf.write(d)
-			else:
-				time.sleep(0.5)
-			# generate noise
-			#hf.write(bytes(i for i in range(hf.sco_payload)))
+		loopback(hf)
 	except KeyboardInterrupt:
 		pass
 	hf.close()
-	logging.info('\nExiting...')
+	_LOG.info('\nExiting...')
 
 if __name__ == '__main__':
 	main()